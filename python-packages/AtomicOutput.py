@@ -1,6 +1,7 @@
 import os
 import sys
-import traceback
+
+debug = "TOOLKIT_DEBUG" in os.environ
 
 
 class AtomicOutput:
@@ -57,7 +58,8 @@ class AtomicOutput:
             self.close()
             return True
         except Exception as ex:
-            if os.environ["TOOLKIT_DEBUG"] is not None:
+            if debug:
+                import traceback
                 traceback.print_exception(ex)
             else:
                 print(f"{sys.argv[0]}: {ex}", file=sys.stderr)
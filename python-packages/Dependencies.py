@@ -38,17 +38,17 @@ class Dependencies:
         self.filename = filename
         self.target = target
         self.dependencies.add(sys.argv[0])
-        directory = os.path.dirname(__file__)
-        for module in sys.modules.keys():
-            filename = os.path.join(directory, f"{module}.py")
-            if os.path.exists(filename):
-                self.dependencies.add(filename)
 
     def add(self, filename):
         self.dependencies.add(filename)
 
     def write(self):
         if self.filename is not None:
+            # Modules may be imported lazily, so collect them only now.
+            directory = os.path.dirname(__file__)
+            for module in sys.modules.keys():
+                module_file = os.path.join(directory, f"{module}.py")
+                if os.path.exists(module_file):
+                    self.dependencies.add(module_file)
             with open(self.filename, "w") as file:
-                print(f"{self.target}: ", end="", file=file)
-                print(" ".join(self.dependencies), file=file)
+                file.write(f"{self.target}: {' '.join(self.dependencies)}\n")
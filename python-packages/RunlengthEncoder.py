@@ -27,6 +27,7 @@
 """
 
 import enum
+import itertools
 
 class Trim(enum.Enum):
     none = "none"
@@ -43,8 +44,8 @@ class RunlengthEncoder:
 
     def __init__(self, trim=Trim.trailing, binary=True):
         self.binary = binary
-        self.compressed = self.empty_string()
-        self.literal = self.empty_string()
+        self.compressed = self.empty_buffer()
+        self.literal = self.empty_buffer()
         self.code_runlength = 0x80
         self.code_skip = 0xc0
         self.state = RunlengthEncoder.State.empty
@@ -52,18 +53,52 @@ class RunlengthEncoder:
         self.last_byte = None
         self.trim = trim
 
+    @classmethod
+    def encode(cls, data, trim=Trim.trailing, binary=True):
+        encoder = cls(trim, binary)
+        encoder.add_bytes(data)
+        return encoder.end()
+
     def add_bytes(self, data):
-        for byte in data:
-            self.add(byte)
+        runs = itertools.groupby(data)
+        first = next(runs, None)
+        if first is None:
+            return
+        byte, run = first
+        self.add_run(byte, sum(1 for _ in run))
+
+        # Consecutive runs always differ, so each one ends the previous run.
+        last_byte = self.last_byte
+        length = self.length
+        literal = self.literal
+        for byte, run in runs:
+            if length > 2:
+                self.encode_literal(literal)
+                literal = self.literal = self.empty_buffer()
+                self.encode_run(length, last_byte)
+            elif length == 2:
+                literal.append(last_byte)
+                literal.append(last_byte)
+            else:
+                literal.append(last_byte)
+            last_byte = byte
+            length = sum(1 for _ in run)
+        self.last_byte = last_byte
+        self.length = length
 
     def add(self, byte):
-        self.set_state(RunlengthEncoder.State.char)
-        if byte != self.last_byte:
+        self.add_run(byte, 1)
+
+    def add_run(self, byte, length):
+        if self.set_state(RunlengthEncoder.State.char):
+            self.last_byte = byte
+            self.length = length
+        elif byte != self.last_byte:
             self.end_run()
             self.last_byte = byte
-            self.length = 1
+            self.length = length
         else:
-            self.length += 1
+            self.length += length
 
     def skip(self, amount):
         if amount == 0:
@@ -77,13 +112,16 @@ class RunlengthEncoder:
         if self.state == RunlengthEncoder.State.char or (self.state == RunlengthEncoder.State.skip and self.trim != Trim.trailing and self.trim != Trim.both):
             self.set_state(RunlengthEncoder.State.empty)
         self.encode_end()
-        result = self.compressed
-        self.compressed = self.empty_string()
+        if self.binary:
+            result = bytes(self.compressed)
+        else:
+            result = self.compressed
+        self.compressed = self.empty_buffer()
         return result
 
     def set_state(self, state):
         if self.state == state:
-            return
+            return False
         if self.state == RunlengthEncoder.State.char:
             self.end_char()
         elif self.state == RunlengthEncoder.State.skip:
@@ -91,17 +129,20 @@ class RunlengthEncoder:
         self.state = state
         self.last_byte = None
         self.length = 0
+        return True
 
     def end_run(self):
         if self.state != RunlengthEncoder.State.char:
             return
         if self.length > 2:
             self.encode_literal(self.literal)
-            self.literal = self.empty_string()
+            self.literal = self.empty_buffer()
             self.encode_run(self.length, self.last_byte)
-        else:
-            for i in range(self.length):
-                self.add_literal(self.last_byte)
+        elif self.length == 2:
+            self.literal.append(self.last_byte)
+            self.literal.append(self.last_byte)
+        elif self.length == 1:
+            self.literal.append(self.last_byte)
         self.empty()
 
     def end_char(self):
@@ -109,7 +150,7 @@ class RunlengthEncoder:
             return
         self.end_run()
         self.encode_literal(self.literal)
-        self.literal = b""
+        self.literal = self.empty_buffer()
         self.empty()
 
     def end_skip(self):
@@ -123,56 +164,51 @@ class RunlengthEncoder:
         self.last_byte = None
 
     def encode_literal(self, data):
+        if self.binary:
+            data = memoryview(data)
         offset = 0
         while offset + 127 < len(data):
-            self.output(127)
-            self.output(data[offset:offset+127])
+            self.output_byte(127)
+            self.output_block(data[offset:offset+127])
             offset += 127
         if offset < len(data):
-            self.output(len(data) - offset)
-            self.output(data[offset:])
+            self.output_byte(len(data) - offset)
+            self.output_block(data[offset:])
 
     def encode_run(self, length, byte):
-        while self.length > 63:
-            self.output(self.code_runlength + 63)
-            self.output(byte)
-            self.length -= 63
-        if self.length > 0:
-            self.output(self.code_runlength + self.length)
-            self.output(byte)
+        if length > 63:
+            full_run = self.code_runlength + 63
+            while length > 63:
+                self.output_byte(full_run)
+                self.output_byte(byte)
+                length -= 63
+        if length > 0:
+            self.output_byte(self.code_runlength + length)
+            self.output_byte(byte)
 
     def encode_skip(self, length):
         while length > 63:
-            self.output(self.code_skip + 63)
+            self.output_byte(self.code_skip + 63)
             length -= 63
         if length > 0:
-            self.output(self.code_skip + length)
+            self.output_byte(self.code_skip + length)
 
     def encode_end(self):
-        self.output(self.code_skip)
+        self.output_byte(self.code_skip)
 
-    def output(self, byte):
+    def output_byte(self, byte):
         if self.binary:
-            if type(byte) is bytes:
-                self.compressed += byte
-            else:
-                self.compressed += byte.to_bytes(1, byteorder="little")
+            self.compressed.append(byte)
         else:
-            if type(byte) is list:
-                self.compressed += byte
-            else:
-                if type(byte) is int:
-                    byte = "$%0.2x" % byte
-                self.compressed.append(byte)
+            if type(byte) is int:
+                byte = "$%0.2x" % byte
+            self.compressed.append(byte)
+
+    def output_block(self, data):
+        self.compressed.extend(data)
 
-    def empty_string(self):
+    def empty_buffer(self):
         if self.binary:
-            return b""
+            return bytearray()
         else:
             return []
-    
-    def add_literal(self, byte):
-        if self.binary:
-            self.literal += byte.to_bytes(1, byteorder="little")
-        else:
-            self.literal.append(byte)
@@ -1,3 +1,4 @@
+import itertools
 import os.path
 import re
 import sys
@@ -5,13 +6,13 @@ import sys
 import AssemblerOutput
 import RunlengthEncoder
 
-map_chars = r"'(.)'(?:-'(.)')?"
-map_codes = r"\$([0-9a-fA-F]*)(?:-\$([0-9a-fA-F]*))?"
+map_chars = re.compile(r"'(.)'(?:-'(.)')?")
+map_codes = re.compile(r"\$([0-9a-fA-F]*)(?:-\$([0-9a-fA-F]*))?")
+variable = re.compile(r"\${[A-Z_]*}")
 
 class ExpressionParser:
-    def __init__(self, defines):
+    def __init__(self):
         self.tokens = []
-        self.defines = defines
 
     def parse(self, tokens):
         self.tokens = tokens
@@ -20,11 +21,11 @@ class ExpressionParser:
         if len(self.tokens) == 0:
             raise RuntimeError("empty conditional")
 
-        value = self.parse_expression()
+        predicate = self.parse_expression()
         token = self.get()
         if token != "":
             raise RuntimeError(f"unexpected {token}")
-        return value
+        return predicate
 
     def get(self):
         if len(self.tokens) > 0:
@@ -33,29 +34,32 @@ class ExpressionParser:
             return ""
 
     def parse_expression(self):
-        value = self.parse_term()
+        term = self.parse_term()
         token = self.get()
         if token == "and":
-            return self.parse_expression() and value
+            rest = self.parse_expression()
+            return lambda defines: rest(defines) and term(defines)
         elif token == "or":
-            return self.parse_expression() or value
+            rest = self.parse_expression()
+            return lambda defines: rest(defines) or term(defines)
         else:
             self.unget(token)
-            return value
+            return term
 
     def parse_term(self):
         token = self.get()
         if token == "not":
-            return not self.parse_term()
+            term = self.parse_term()
+            return lambda defines: not term(defines)
         elif token == "(":
-            value = self.parse_expression()
+            predicate = self.parse_expression()
             if self.get() != ")":
-                RuntimeError("syntax error, expected )")
-            return value
+                raise RuntimeError("syntax error, expected )")
+            return predicate
         elif token == ")" or token == "and" or token == "or":
             raise RuntimeError(f"syntax error, unexpected {token}")
         else:
-            return token in self.defines
+            return lambda defines: token in defines
 
     def unget(self, token):
         self.tokens.append(token)
@@ -65,17 +69,28 @@ class Source:
     def __init__(self, filename):
         self.filename = filename
         self.line_number = 0
-        self.file = open(filename, mode="r")
-
-    def readline(self):
-        self.line_number += 1
-        return self.file.readline()
+        self.file = open(filename, mode="r", encoding="utf-8")
+        self.lines = enumerate(self.file, 1)
 
     def error_prefix(self):
         return f"{self.filename}:{self.line_number}"
 
 
 class Screens:
+    preamble_commands = {
+        "line_length": lambda self, words: setattr(self, "line_length", int(words[1])),
+        "lines": lambda self, words: setattr(self, "lines", int(words[1])),
+        "line_skip": lambda self, words: setattr(self, "line_skip", int(words[1])),
+        "title_length": lambda self, words: setattr(self, "title_length", int(words[1])),
+        "image_padding_left": lambda self, words: setattr(self, "image_padding_left", self.map_string(words[1])),
+        "image_padding_right": lambda self, words: setattr(self, "image_padding_right", self.map_string(words[1])),
+        "map": lambda self, words: self.add_map(words[1], words[2]),
+        "name": lambda self, words: setattr(self, "name", words[1]),
+        "title_xor": lambda self, words: setattr(self, "title_xor", int(words[1])),
+        "single_screen": lambda self, words: setattr(self, "single_screen", int(words[1])),
+        "word_wrap": lambda self, words: setattr(self, "word_wrap", int(words[1]))
+    }
+
     def __init__(self, dependencies, options=None, defines=None, include_directories=None, images=None, assembler_output=None):
         self.name = ""
         self.title_length = 0
@@ -88,9 +103,14 @@ class Screens:
         self.postfix = b""
         self.word_wrap = False
         self.include_directories = include_directories or []
+        self.search_directories = ()
+        self.found_files = {}
+        self.existing_files = {}
+        self.directories = {}
         self.images = images or []
         self.image_padding_left = b""
         self.image_padding_right = b""
+        self.padded_images = {}
 
         self.dependencies = dependencies
         self.encoder = RunlengthEncoder.RunlengthEncoder()
@@ -109,6 +129,8 @@ class Screens:
             self.set_options(options)
         self.defines = {}
         self.charmap = {}
+        self.translation_tables = {}
+        self.conditions = {}
 
         if defines is not None:
             for define in defines:
@@ -124,6 +146,8 @@ class Screens:
 
     def convert(self, input_file, output_file):
         self.input_file = input_file
+        self.search_directories = (os.path.dirname(input_file),) + tuple(self.include_directories)
+        self.found_files = {}
         self.dependencies.add(self.input_file)
         self.files = [Source(input_file)]
         self.in_preamble = True
@@ -148,29 +172,69 @@ class Screens:
         self.ok = False
 
     def eval_if(self, expression):
-        parser = ExpressionParser(self.defines)
-        try:
-            return parser.parse(expression)
-        except Exception as e:
-            self.error("invalid conditional: " + str(e))
-            return False
+        key = tuple(expression)
+        predicate = self.conditions.get(key)
+        if predicate is None:
+            try:
+                predicate = ExpressionParser().parse(list(expression))
+            except Exception as e:
+                self.error("invalid conditional: " + str(e))
+                return False
+            self.conditions[key] = predicate
+        return predicate(self.defines)
+
+    def file_exists(self, file_name):
+        exists = self.existing_files.get(file_name)
+        if exists is None:
+            exists = os.path.lexists(file_name)
+            self.existing_files[file_name] = exists
+        return exists
+
+    def directory_entries(self, directory):
+        entries = self.directories.get(directory)
+        if entries is None:
+            try:
+                with os.scandir(directory or ".") as iterator:
+                    entries = {entry.name for entry in iterator}
+            except OSError:
+                entries = set()
+            self.directories[directory] = entries
+        return entries
 
     def find_file(self, file_name):
-        if os.path.exists(file_name):
+        name = self.found_files.get(file_name)
+        if name is None:
+            name = self.search_file(file_name)
+            self.found_files[file_name] = name
+        return name
+
+    def search_file(self, file_name):
+        if self.file_exists(file_name):
             return file_name
-        for directory in [os.path.dirname(self.input_file)] + self.include_directories:
+        if os.path.isabs(file_name):
+            # Joining an absolute path to a search directory yields the path itself.
+            raise RuntimeError(f"file {file_name} not found")
+        # Plain file names are first looked up in a listing of each directory; the probe keeps the file system's own lookup rules (case, normalization).
+        in_directory = os.path.dirname(file_name) == ""
+        for directory in self.search_directories:
             name = os.path.join(directory, file_name)
-            if os.path.exists(name):
+            if (in_directory and file_name in self.directory_entries(directory)) or self.file_exists(name):
                 return name
         raise RuntimeError(f"file {file_name} not found")
-    
+
     def process(self):
         while len(self.files) > 0:
-            while line := self.files[-1].readline():
+            source = self.files[-1]
+            for source.line_number, line in source.lines:
                 self.process_line(line)
-            if len(self.showing) != 1:
-                self.error(f"unclosed .if")
-            self.files.pop()
+                if self.files[-1] is not source:
+                    # .include pushed a new file, continue there.
+                    break
+            else:
+                if len(self.showing) != 1:
+                    self.error(f"unclosed .if")
+                self.files.pop()
+                source.file.close()
         self.end()
 
     def process_line(self, line):
@@ -234,7 +298,7 @@ class Screens:
             self.add_image(self.images[0])
         elif line.startswith(".image "):
             index = int(line[7:])
-            self.add_image(self.image[index])
+            self.add_image(self.images[index])
         elif line.startswith(".include "):
             start = line.find("\"")
             end = line.rfind("\"")
@@ -257,7 +321,10 @@ class Screens:
         with open(filename, "rb") as file:
             data = file.read()
             # TODO: handle prefix / postfix
-            self.current_line += len(data) / self.line_length
+            lines, remainder = divmod(len(data), self.line_length)
+            if remainder != 0:
+                self.error(f"size of binary file {filename} is not a multiple of line length {self.line_length}")
+            self.current_line += lines
             if self.current_line > self.lines:
                 self.error("too many lines")
             self.encoder.add_bytes(data)
@@ -271,36 +338,17 @@ class Screens:
             self.postfix = self.parse_fix(line)
         else:
             words = line.split(" ")
-            if words[0] == "line_length":
-                self.line_length = int(words[1])
-            elif words[0] == "lines":
-                self.lines = int(words[1])
-            elif words[0] == "line_skip":
-                self.line_skip = int(words[1])
-            elif words[0] == "title_length":
-                self.title_length = int(words[1])
-            elif words[0] == "image_padding_left":
-                self.image_padding_left = self.map_string(words[1])
-            elif words[0] == "image_padding_right":
-                self.image_padding_right = self.map_string(words[1])
-            elif words[0] == "map":
-                self.add_map(words[1], words[2])
-            elif words[0] == "name":
-                self.name = words[1]
-            elif words[0] == "title_xor":
-                self.title_xor = int(words[1])
-            elif words[0] == "single_screen":
-                self.single_screen = int(words[1])
-            elif words[0] == "word_wrap":
-                self.word_wrap = int(words[1])
-            else:
-                raise RuntimeError(f"unknown command '" + words[0] + "' in line {self.line_number}")
+            command = Screens.preamble_commands.get(words[0])
+            if command is None:
+                raise RuntimeError(f"unknown command '{words[0]}' in line {self.files[-1].line_number}")
+            command(self, words)
 
     def process_screen_line(self, line):
         if line == "---":
             self.end_screen()
         else:
-            line = re.sub(r"\${[A-Z_]*}", lambda m: self.replace_variable(m), line)
+            if "${" in line:
+                line = variable.sub(self.replace_variable, line)
             if self.title_length > 0 and self.current_title == b"":
                 if len(line) > self.title_length:
                     self.error(f"title too long: '{line}'")
@@ -336,17 +384,16 @@ class Screens:
         self.current_line += 1
         if self.current_line == self.lines + 1:
             self.error(f"too many lines in screen")
+        encoder = self.encoder
         if self.current_line > 1 and self.line_skip > 0:
-            self.encoder.skip(self.line_skip)
-        self.encoder.add_bytes(self.prefix)
-        self.add_string(line, self.line_length)
-        self.encoder.add_bytes(self.postfix)
+            encoder.skip(self.line_skip)
+        encoder.add_bytes(self.prefix + self.map_string(line.ljust(self.line_length)) + self.postfix)
 
     def end_screen(self):
         if self.current_title != b"" or self.current_line > 0:
             while self.current_line < self.lines:
                 self.add_line("")
-            self.compressed_screens.append(self.current_title + self.encoder.end())
+            self.compressed_screens.append((self.current_title, self.encoder.end()))
             self.current_title = b""
             self.current_line = 0
             self.ignore_empty_line = False
@@ -355,14 +402,14 @@ class Screens:
         self.end_screen()
 
     def add_map(self, source_string, target_string):
-        match = re.search(map_chars, source_string)
+        match = map_chars.search(source_string)
         if match:
             source_range = [ord(match.group(1)[0])]
             end = match.group(2)
             if end is not None:
                 source_range.append(ord(end[0]))
         else:
-            match = re.search(map_codes, source_string)
+            match = map_codes.search(source_string)
             if match:
                 source_range = [int("0x" + match.group(1), 0)]
                 end = match.group(2)
@@ -377,21 +424,39 @@ class Screens:
         for source in range(source_range[0], source_range[1] + 1):
             self.charmap[source] = target
             target += 1
-
-    def add_bytes(self, string):
-        self.encoder.add_bytes(string)
+        self.translation_tables = {}
 
     def add_string(self, string, length, byte_xor=0):
         self.encoder.add_bytes(self.map_string(string.ljust(length), byte_xor))
 
     def map_string(self, string, byte_xor=0):
-        result = b""
+        table, unmapped = self.translation_table(byte_xor)
+        try:
+            encoded = string.encode("latin-1")
+            result = encoded.translate(table, unmapped)
+            if len(result) == len(encoded):
+                return result
+        except UnicodeEncodeError:
+            pass
+
+        # Report unmapped characters.
+        result = bytearray()
         for c in string:
-            if ord(c) not in self.charmap:
+            code = self.charmap.get(ord(c))
+            if code is None:
                 self.error(f"unmapped character '{c}'")
                 continue
-            result += (self.charmap[ord(c)] ^ byte_xor).to_bytes(1, byteorder="little")
-        return result
+            result += (code ^ byte_xor).to_bytes(1, byteorder="little")
+        return bytes(result)
+
+    def translation_table(self, byte_xor):
+        if byte_xor not in self.translation_tables:
+            # Codes whose target doesn't fit in a byte are left to the per-character fallback.
+            mapped = {code: target ^ byte_xor for code, target in self.charmap.items() if code < 256 and 0 <= target ^ byte_xor <= 0xff}
+            table = bytes(mapped.get(code, 0) for code in range(256))
+            unmapped = bytes(code for code in range(256) if code not in mapped)
+            self.translation_tables[byte_xor] = (table, unmapped)
+        return self.translation_tables[byte_xor]
 
     def parse_fix(self, line):
         # TODO: support for byte list
@@ -435,10 +500,10 @@ class Screens:
         output.data_section()
         if self.single_screen:
             output.global_symbol(self.name)
-            output.bytes(self.compressed_screens[0])
+            output.bytes(itertools.chain(*self.compressed_screens[0]))
             output.end_object()
         else:
-            output.parts(self.name, self.compressed_screens)
+            output.parts(self.name, [itertools.chain(*screen) for screen in self.compressed_screens])
 
     def add_image(self, image):
         width = image["width"]
@@ -449,7 +514,8 @@ class Screens:
         if len(self.image_padding_left) + len(self.image_padding_right) + width != self.line_length:
             self.error(f"image width {width} plus padding {len(self.image_padding_left)}+{len(self.image_padding_right)} is not line length {self.line_length}")
         # TODO: check that image width + padding is line length
-        for y in range(height):
-            self.add_bytes(self.image_padding_left)
-            self.add_bytes(image["data"][width*y:width*(y+1)])
-            self.add_bytes(self.image_padding_right)
+        data = self.padded_images.get(id(image))
+        if data is None:
+            data = b"".join(self.image_padding_left + bytes(image["data"][width*y:width*(y+1)]) + self.image_padding_right for y in range(height))
+            self.padded_images[id(image)] = data
+        self.encoder.add_bytes(data)
@@ -2,9 +2,7 @@ import argparse
 import os
 import sys
 
-import AssemblerOutput
 import AtomicOutput
-import Dependencies
 
 class Options:
     def __init__(self, assembler_output=False, runlength_encode=False, symbol_name=False) -> None:
@@ -12,6 +10,14 @@ class Options:
         self.runlength_encode = runlength_encode
         self.symbol_name = symbol_name
 
+# Stands in for Dependencies when no depfile is requested.
+class NullDependencies:
+    def add(self, filename):
+        pass
+
+    def write(self):
+        pass
+
 class Script:
     # Public API
 
@@ -21,7 +27,7 @@ class Script:
         self.arg_parser.add_argument("-M", metavar="FILE", dest="depfile", help="output dependency information to FILE")
         self.arg_parser.add_argument("-o", metavar="FILE", dest="output_filename", help="write output to FILE")
         self.output = AtomicOutput.AtomicOutput()
-        self.dependencies = None
+        self.dependencies = NullDependencies()
 
         if self.options.runlength_encode:
             self.arg_parser.add_argument("-r", dest="runlength", action="store_true", help="runlength encode data")
@@ -29,6 +35,8 @@ class Script:
             self.arg_parser.add_argument("-n", metavar="NAME", dest="symbol_name", help="define symbol NAME")
 
         self.assembler = None
+        self.resolved_output_filename = None
+        self.resolved_symbol_name = None
 
     def run(self):
         try:
@@ -37,7 +45,9 @@ class Script:
             self.prepare()
 
             self.output.set_filename(self.output_filename())
-            self.dependencies = Dependencies.Dependencies(self.args.depfile, self.output_filename())
+            if self.args.depfile is not None:
+                import Dependencies
+                self.dependencies = Dependencies.Dependencies(self.args.depfile, self.output_filename())
             if not self.output.run(lambda: self.execute()):
                 sys.exit(1)
         except Exception as ex:
@@ -54,9 +64,12 @@ class Script:
     
     # Get filename of final output file.
     def output_filename(self):
-        if self.args.output_filename is not None:
-            return self.args.output_filename
-        return self.default_output_filename()
+        if self.resolved_output_filename is None:
+            if self.args.output_filename is not None:
+                self.resolved_output_filename = self.args.output_filename
+            else:
+                self.resolved_output_filename = self.default_output_filename()
+        return self.resolved_output_filename
 
     # Get temporary output file
     def output_file(self):
@@ -68,10 +81,13 @@ class Script:
 
     # Get name of assembler symbol.
     def symbol_name(self):
-        if self.args.symbol_name is not None:
-            return self.args.symbol_name
-        # TODO: remove invalid characters
-        return os.path.splitext(self.input_filename())[0].replace("-", "_")
+        if self.resolved_symbol_name is None:
+            if self.args.symbol_name is not None:
+                self.resolved_symbol_name = self.args.symbol_name
+            else:
+                # TODO: remove invalid characters
+                self.resolved_symbol_name = os.path.splitext(self.input_filename())[0].replace("-", "_")
+        return self.resolved_symbol_name
 
 
     # Required Subclass Methods
@@ -108,6 +124,7 @@ class Script:
     # Set up and call actual processing.
     def execute(self):
         if self.options.assembler_output:
+            import AssemblerOutput
             self.assembler = AssemblerOutput.AssemblerOutput(self.output_file())
             self.assembler.header(self.input_filename())
             self.assembler.data_section()